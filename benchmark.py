@@ -0,0 +1,164 @@
+from twisted.internet import reactor, protocol
+from twisted.protocols import basic
+import os
+import sys
+import re
+import time
+
+
+class BenchmarkClient(basic.LineReceiver):
+    """
+    This class exists as a protocol for one side of the benchmark. Every line from the server is handed to the Benchmark
+    """
+    delimiter = "\n"
+
+    def __init__(self, benchmark, name):
+        self.benchmark = benchmark
+        self.name = name
+        self.loggedIn = False
+
+    def connectionMade(self):
+        self.benchmark.connected(self)
+
+    def connectionLost(self, reason):
+        self.benchmark.disconnected(self)
+
+    def lineReceived(self, line):
+        line = line.strip()
+        if line:
+            self.benchmark.responseReceived(self, line)
+
+    def command(self, command, params):
+        self.sendLine("{}{} {}".format(self.benchmark.prefix, command, params))
+
+
+class BenchmarkClientFactory(protocol.ClientFactory):
+    """
+    Factory for the benchmark clients
+    """
+
+    def __init__(self, benchmark, name):
+        self.benchmark = benchmark
+        self.name = name
+
+    def buildProtocol(self, addr):
+        return BenchmarkClient(self.benchmark, self.name)
+
+    def clientConnectionFailed(self, connector, reason):
+        print("Connection for {} failed - goodbye!".format(self.name))
+        if reactor.running:
+            reactor.stop()
+
+
+class Benchmark:
+    """
+    Measures how long a room message takes to reach a user on another server. A sender and a receiver join the same room on
+    their own servers, then the sender sends one message at a time and the next message is sent once the receiver gets the last one
+    """
+
+    def __init__(self, prefix, count):
+        self.prefix = prefix
+        self.count = count
+        tag = "{}{}".format(os.getpid(), int(time.time()))
+        self.room = "bench{}".format(tag)
+        self.sender = None
+        self.receiver = None
+        self.ready = []
+        self.sent = {}
+        self.latencies = []
+        self.done = False
+
+    def connected(self, client):
+        if client.name == "sender":
+            self.sender = client
+        else:
+            self.receiver = client
+        client.user = "{}{}".format(client.name, self.room)
+        client.command("open", "Open plz")
+        client.command("login", "{} bench".format(client.user))
+        client.command("login", "{} bench".format(client.user))
+
+    def disconnected(self, client):
+        if not self.done:
+            print("Lost connection for {} - goodbye!".format(client.name))
+            if reactor.running:
+                reactor.stop()
+
+    def responseReceived(self, client, line):
+        words = line.split()
+        command = words[0][len(self.prefix):]
+        if command == "login":
+            client.loggedIn = True
+            if client is self.sender:
+                client.command("create", self.room)
+            else:
+                self.joinRoom(client)
+        elif command == "create" and client.loggedIn:
+            # Registering a user is also answered with create, so only the response to creating the room counts
+            self.joinRoom(client)
+        elif command == "join":
+            self.ready.append(client)
+            if len(self.ready) == 2:
+                self.sendNext()
+        elif command == "error" and not client in self.ready and "room" in line:
+            # The room is made on the sender's server and may not have reached the receiver's server yet
+            reactor.callLater(0.05, self.joinRoom, client)
+        elif command == "error":
+            print("Error from {}: {}".format(client.name, line))
+        elif command == "msg" and client is self.receiver:
+            self.messageReceived(words[-1])
+
+    def joinRoom(self, client):
+        client.command("join", self.room)
+
+    def sendNext(self):
+        number = str(len(self.latencies))
+        self.sent[number] = time.time()
+        self.sender.command("msg", "{} | {}".format(self.room, number))
+
+    def messageReceived(self, number):
+        if not number in self.sent:
+            return
+        self.latencies.append((time.time() - self.sent.pop(number)) * 1000)
+        if len(self.latencies) < self.count:
+            self.sendNext()
+        else:
+            self.finish()
+
+    def finish(self):
+        self.done = True
+        latencies = sorted(self.latencies)
+        print("Cross-node delivery latency over {} messages:".format(len(latencies)))
+        print("  min {:.3f} ms".format(latencies[0]))
+        print("  avg {:.3f} ms".format(sum(latencies) / len(latencies)))
+        print("  p50 {:.3f} ms".format(latencies[len(latencies) // 2]))
+        print("  p99 {:.3f} ms".format(
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]))
+        print("  max {:.3f} ms".format(latencies[-1]))
+        self.sender.command("logout", "")
+        self.receiver.command("logout", "")
+        reactor.callLater(0.1, reactor.stop)
+
+
+if __name__ == '__main__':
+    prefix = "!"
+    count = 1000
+    sender = ("localhost", 8000)
+    receiver = ("localhost", 8001)
+    for arg in sys.argv:
+        if re.search("^--prefix=.$", arg):
+            prefix = arg[-1]
+        elif re.search("^--count=[0-9]+$", arg):
+            count = max(1, int(arg.split("=", 1)[1]))
+        elif re.search("^--sender=.+:[0-9]+$", arg):
+            (host, port) = arg.split("=", 1)[1].rsplit(":", 1)
+            sender = (host, int(port))
+        elif re.search("^--receiver=.+:[0-9]+$", arg):
+            (host, port) = arg.split("=", 1)[1].rsplit(":", 1)
+            receiver = (host, int(port))
+    benchmark = Benchmark(prefix, count)
+    reactor.connectTCP(sender[0], sender[1],
+                       BenchmarkClientFactory(benchmark, "sender"))
+    reactor.connectTCP(receiver[0], receiver[1],
+                       BenchmarkClientFactory(benchmark, "receiver"))
+    reactor.run()
@@ -5,6 +5,9 @@ class User:
         self.active = False
         self.rooms = []
         self.protocol = None
+        self.origin = None
+        self.registered = None
+        self.node = None
 
 
 class MessageChain:
@@ -39,11 +42,13 @@ class MessageChain:
 
 
 class Message:
-    def __init__(self, location, sender, time, text):
+    def __init__(self, location, sender, time, text, id=None):
         self.location = location
         self.sender = sender
         self.time = time
         self.text = text
+        self.id = id
+        self.origin = None
 
     def getFormatted(self):
         return "[{}]({})<{}>: {}".format(self.location, self.time.strftime("%m/%d/%Y@%H:%M:%S"), self.sender, self.text)
@@ -1,8 +1,12 @@
-from twisted.internet import reactor, protocol
+from twisted.internet import reactor, protocol, stdio
+from twisted.internet.interfaces import IHalfCloseableProtocol
+from twisted.protocols import basic
 from twisted.words.protocols import irc
-import threading
+from zope.interface import implementer
+import os
 import sys
 import re
+import time
 from chat_classes import *
 
 # a client protocol
@@ -15,20 +19,37 @@ class ChatClient(irc.IRCClient):
     This code leverages code from Twisted Python and was inspired by the following skeleton example:
         https://twistedmatrix.com/documents/current/core/howto/clients.html
     However, a lot of the functionality in the base class (IRCClient) is unused in favor of simpler code that just reads and prints messages
+
+    Commands are read from a ChatConsole on the reactor rather than from a separate thread. In batch mode the commands are written to the
+    server as soon as they are read without waiting on responses, and a ping is sent after each command when timing latency
     """
     delimiter = "\n"
+    # Seconds batch mode waits on the server after the last command before giving up
+    finishTimeout = 10
 
-    def __init__(self, prefix, debug):
-        self.prefix = "!"
+    def __init__(self, prefix, debug, console, batch=False, latency=False):
+        self.prefix = prefix
         self.debug = debug
+        self.console = console
+        self.batch = batch
+        self.latency = latency
+        self.ready = False
         self.readingInput = False
+        self.pings = {}
+        self.pingCount = 0
+        self.finalPing = None
+        self.latencies = []
+        self.finishCall = None
 
     def connectionMade(self):
-        print("connection made")
-        self.sendLine("!open Open plz")
+        self.console.write("connection made")
+        self.sendLine("{}open Open plz".format(self.prefix))
 
     def connectionLost(self, reason):
-        print("connection with server lost - closing application")
+        if self.finishCall and self.finishCall.active():
+            self.finishCall.cancel()
+        self.console.write("connection with server lost - closing application")
+        self.console.detach()
 
     def parsemsg(self, input):
         if not input:
@@ -38,15 +59,18 @@ class ChatClient(irc.IRCClient):
         command = words[0].replace(prefix, "").lower()
         return (command, prefix, words[1:])
 
-    def dataReceived(self, data):
+    def lineReceived(self, data):
         """
-        Method invoked when data passed through connection.  Parses input into three parts - a prefix, a command, and a list of words
+        Method invoked for each line passed through connection.  Parses input into three parts - a prefix, a command, and a list of words
 
         """
         (command, prefix, content) = self.parsemsg(data)
+        # Any response shows the server is still working through the script
+        if self.finishCall and self.finishCall.active():
+            self.finishCall.reset(self.finishTimeout)
         # Check prefix matches server
         if command == "unknown" or data.strip() == "":
-            print("Unknown response from server")
+            self.console.write("Unknown response from server")
             self.transport.loseConnection()
         elif command == "open" and prefix == "":
             self.prefix = data[0]
@@ -55,22 +79,81 @@ class ChatClient(irc.IRCClient):
         elif command == "close":
             self._printMessage(data)
             self.transport.loseConnection()
+        elif command == "pong" and prefix == self.prefix:
+            if self.debug:
+                self._printMessage(data)
+            self._receivePong(content)
         else:
             self._printMessage(data)
-            # Create a thread to read input while main prints messages
-            if not self.readingInput:
-                input = threading.Thread(target=self._pollInput)
-                input.setDaemon(True)  # End thread upon exit
-                input.start()
+            # Start taking commands once the server has answered, showing a new prompt if one is not active
+            if not self.ready:
+                self.ready = True
+                self.console.attach(self)
+            if not self.batch and not self.readingInput:
+                self.readingInput = True
+                self.console.prompt(">> ")
+
+    def inputReceived(self, line):
+        """
+        Method called by the console for each command read from the user or script
+        """
+        if self.batch:
+            if line.strip() == "":
+                return
+            self.sendLine(line)
+            if self.latency:
+                self._sendPing(line)
+        else:
+            self.readingInput = False
+            self.sendLine(line)
+
+    def inputFinished(self):
+        """
+        Method called by the console once no more commands can be read. Batch mode waits on a final ping so all responses are printed before closing
+        """
+        if self.batch:
+            self.finalPing = self._sendPing(None)
+            self.finishCall = reactor.callLater(
+                self.finishTimeout, self._finishTimedOut)
+        else:
+            self.transport.loseConnection()
+
+    def _finishTimedOut(self):
+        """
+        Method called when the server stops responding before answering the final ping, e.g. because it expects another prefix
+        """
+        self.console.write(
+            "No response to final {}ping from server - closing".format(self.prefix))
+        self.transport.loseConnection()
+
+    def _sendPing(self, line):
+        """
+        Method to send a ping after a command, recording when it was sent so the matching pong gives the latency of the command
+        """
+        self.pingCount = self.pingCount + 1
+        token = str(self.pingCount)
+        self.pings[token] = (line, time.time())
+        self.sendLine("{}ping {}".format(self.prefix, token))
+        return token
 
-    def _pollInput(self):
+    def _receivePong(self, content):
         """
-        Method called in a separate thread to take command inputs
+        Method to match a pong to its ping. Responses arrive in order so every response to the command was received before its pong
         """
-        self.readingInput = True  # Lock input so multiple threads not spawned
-        d = raw_input(">> ")
-        self.sendLine(d)
-        self.readingInput = False  # Unlock input so new threads spawned
+        if len(content) == 0 or not content[0] in self.pings:
+            return
+        token = content[0]
+        (line, sent) = self.pings.pop(token)
+        elapsed = (time.time() - sent) * 1000
+        if line is not None:
+            self.latencies.append(elapsed)
+            self.console.write(
+                "[latency] {:.3f} ms: {}".format(elapsed, line.strip()))
+        if token == self.finalPing:
+            if self.latency and len(self.latencies) > 0:
+                self.console.write("[latency] {} commands, avg {:.3f} ms, max {:.3f} ms".format(
+                    len(self.latencies), sum(self.latencies) / len(self.latencies), max(self.latencies)))
+            self.transport.loseConnection()
 
     def _printMessage(self, data):
         """
@@ -81,9 +164,73 @@ class ChatClient(irc.IRCClient):
         if not self.debug:
             data = " ".join(data.split()[1:])
         if self.readingInput:
-            print("\n{}".format(data))
+            self.console.write("\n{}".format(data))
         else:
-            print("{}".format(data))
+            self.console.write("{}".format(data))
+
+
+@implementer(IHalfCloseableProtocol)
+class ChatConsole(basic.LineReceiver):
+    """
+    Protocol for standard input/output through the reactor. Lines are held until a ChatClient is attached and then passed to it
+    as commands. The input may be a terminal, a pipe or a script file
+    """
+    delimiter = "\n"
+
+    def __init__(self):
+        self.client = None
+        self.pending = []
+        self.finished = False
+
+    def lineReceived(self, line):
+        line = line.rstrip("\r")
+        if self.client:
+            self.client.inputReceived(line)
+        else:
+            self.pending.append(line)
+
+    def readConnectionLost(self):
+        self.finished = True
+        if self.client:
+            self.client.inputFinished()
+
+    def writeConnectionLost(self):
+        pass
+
+    def connectionLost(self, reason):
+        if reactor.running:
+            reactor.stop()
+
+    def attach(self, client):
+        """
+        Hands a ready client any commands read so far along with every later command
+        """
+        self.client = client
+        pending = self.pending
+        self.pending = []
+        for line in pending:
+            client.inputReceived(line)
+        if self.finished:
+            client.inputFinished()
+
+    def detach(self):
+        self.client = None
+
+    def write(self, data):
+        self.transport.write("{}\n".format(data))
+
+    def prompt(self, data):
+        self.transport.write(data)
+
+    def close(self):
+        """
+        Closes standard input/output once pending output is written, which then stops the reactor
+        """
+        if self.transport.disconnected:
+            if reactor.running:
+                reactor.stop()
+        else:
+            self.transport.loseConnection()
 
 
 class ChatClientFactory(protocol.ClientFactory):
@@ -91,32 +238,58 @@ class ChatClientFactory(protocol.ClientFactory):
     Factory for client
     """
 
-    def __init__(self, prefix, debug):
+    def __init__(self, prefix, debug, console, batch=False, latency=False):
         self.prefix = prefix
         self.showCommands = debug
+        self.console = console
+        self.batch = batch
+        self.latency = latency
 
     def buildProtocol(self, addr):
-        return ChatClient(self.prefix, self.showCommands)
+        return ChatClient(self.prefix, self.showCommands, self.console, self.batch, self.latency)
 
     def clientConnectionFailed(self, connector, reason):
-        print("Connection failed - goodbye!")
-        if reactor.running:
-            reactor.stop()
+        self.console.write("Connection failed - goodbye!")
+        self.console.close()
 
     def clientConnectionLost(self, connector, reason):
-        print("Connection lost - goodbye!")
-        if reactor.running:
-            reactor.stop()
+        self.console.write("Connection lost - goodbye!")
+        self.console.close()
 
 
 if __name__ == '__main__':
     prefix = "!"
     debug = False
+    host = "localhost"
+    port = 8000
+    batch = False
+    latency = False
+    script = None
     for arg in sys.argv:
         if re.search("^--prefix=.$", arg):
             prefix = arg[-1]
         elif arg == "--debug":
             debug = True
-    f = ChatClientFactory(prefix, debug)
-    reactor.connectTCP("localhost", 8000, f)
+        elif re.search("^--host=.+$", arg):
+            host = arg.split("=", 1)[1]
+        elif re.search("^--port=[0-9]+$", arg):
+            port = int(arg.split("=", 1)[1])
+        elif re.search("^--script=.+$", arg):
+            script = arg.split("=", 1)[1]
+            batch = True
+        elif arg == "--batch":
+            batch = True
+        elif arg == "--latency":
+            latency = True
+    console = ChatConsole()
+    if script and script != "-":
+        if not os.path.isfile(script):
+            print("Cannot find script file '{}'".format(script))
+            sys.exit(1)
+        scriptFile = open(script)
+        stdio.StandardIO(console, stdin=scriptFile.fileno())
+    else:
+        stdio.StandardIO(console)
+    f = ChatClientFactory(prefix, debug, console, batch, latency)
+    reactor.connectTCP(host, port, f)
     reactor.run()
@@ -0,0 +1,420 @@
+from twisted.internet import reactor, protocol, task
+from twisted.protocols import basic
+from datetime import datetime
+import json
+import uuid
+from chat_classes import *
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def _encode(value):
+    """
+    Helper function to turn the unicode strings from json.loads back into str
+    """
+    if isinstance(value, dict):
+        return dict((_encode(key), _encode(item)) for (key, item) in value.items())
+    elif isinstance(value, list):
+        return [_encode(item) for item in value]
+    elif isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+class ChatLink(basic.LineReceiver):
+    """
+    This class exists as a protocol for a persistent link between two chat servers in server.py
+
+    Each line is a JSON object with a "type" naming the event. The first event on a link is a hello carrying the name of the
+    node on the other side and the newest messages it has, after which both sides send a snapshot of what the other is missing
+    and then forward events as they happen.
+
+    Both sides send a heartbeat every heartbeatInterval seconds, and a link that has not heard anything for heartbeatTimeout seconds
+    is aborted so a link that went silently dead is noticed
+    """
+    delimiter = "\n"
+    # Client commands are at most ChatServer.MAX_LENGTH bytes, but JSON can write each byte of them as a 6 character escape
+    MAX_LENGTH = 1024 * 1024
+    heartbeatInterval = 5
+    heartbeatTimeout = 15
+
+    def __init__(self, node, outgoing, clock=reactor):
+        self.node = node
+        self.outgoing = outgoing
+        self.clock = clock
+        self.peer = None
+        self.peerNewest = {}
+        self.lastHeard = None
+        self.heartbeat = None
+
+    def connectionMade(self):
+        self.transport.setTcpKeepAlive(1)
+        self.lastHeard = self.clock.seconds()
+        self.heartbeat = task.LoopingCall(self.checkHeartbeat)
+        self.heartbeat.clock = self.clock
+        self.heartbeat.start(self.heartbeatInterval, now=False)
+        self.sendEvent("hello", node=self.node.name,
+                       newest=self.node.newestMessages())
+
+    def connectionLost(self, reason):
+        if self.heartbeat and self.heartbeat.running:
+            self.heartbeat.stop()
+        self.node.linkLost(self)
+
+    def checkHeartbeat(self):
+        """
+        Method called every heartbeatInterval seconds to send a heartbeat, or to abort the link if the other node has gone quiet
+        """
+        if self.clock.seconds() - self.lastHeard > self.heartbeatTimeout:
+            print("No heartbeat from node '{}' - closing link".format(self.peer))
+            self.transport.abortConnection()
+        else:
+            self.sendEvent("heartbeat")
+
+    def lineReceived(self, line):
+        self.lastHeard = self.clock.seconds()
+        try:
+            event = _encode(json.loads(line))
+        except ValueError:
+            print("Unreadable event from link - closing")
+            self.transport.loseConnection()
+            return
+        if event.get("type") == "heartbeat":
+            return
+        elif event.get("type") == "hello" and not self.peer:
+            self.peer = event.get("node")
+            self.peerNewest = event.get("newest") or {}
+            self.node.linkMade(self)
+        elif self.peer:
+            self.node.handleEvent(self, event)
+
+    def sendEvent(self, type, **fields):
+        """
+        Helper method for sending one event as a line of JSON
+        """
+        fields["type"] = type
+        try:
+            line = json.dumps(fields)
+        except (TypeError, ValueError) as e:
+            print("Skipping '{}' event to node '{}' that cannot be encoded: {}".format(
+                type, self.peer, e))
+            return
+        self.sendLine(line)
+
+
+class ChatLinkFactory(protocol.Factory):
+    """
+    Factory for links accepted from other chat servers
+    """
+
+    def __init__(self, node):
+        self.node = node
+
+    def buildProtocol(self, addr):
+        return ChatLink(self.node, False)
+
+
+class ChatPeerFactory(protocol.ReconnectingClientFactory):
+    """
+    Factory for links opened to other chat servers. The link is retried whenever it fails or is lost
+    """
+    maxDelay = 10
+
+    def __init__(self, node):
+        self.node = node
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        link = ChatLink(self.node, True)
+        link.factory = self
+        return link
+
+
+class ChatNode:
+    """
+    Holds the links of one chat server to the other servers it is federated with and keeps the shared users and message chains in step.
+
+    Every node keeps a full copy of the users, rooms and messages. Events that happen on this node are sent once over each link and are
+    not passed on by the receiving node, so every node should be linked to every other node. A user's session belongs to the node
+    they logged in on; the other nodes mark the user as active with no protocol. When two nodes register the same name, the earlier
+    registration wins. When two nodes hold a session for the same user, the node whose name sorts first wins
+    """
+
+    def __init__(self, name, users, messageChains):
+        self.name = name
+        self.users = users
+        self.messageChains = messageChains
+        self.links = {}
+        self.messageIds = set()
+        # Time of the newest message from each node in each message chain, used to send snapshots with only newer messages
+        self.newest = {}
+
+    # Link handling
+
+    def linkMade(self, link):
+        """
+        Registers a link once its hello is received and sends the other node a snapshot of this node's state. When two links
+        exist to the same node and both were opened by the same side, the new one is kept because the other node only opens a
+        link again after losing the old one. When each side opened one, the link opened by the node whose name sorts first is kept
+        """
+        if link.peer == self.name:
+            print("Dropping link to self")
+            self.dropLink(link)
+            return
+        if link.peer in self.links:
+            old = self.links[link.peer]
+            if old.outgoing == link.outgoing:
+                print("Replacing stale link to node '{}'".format(link.peer))
+                del self.links[link.peer]
+                old.transport.abortConnection()
+            elif link.outgoing == (self.name < link.peer):
+                del self.links[link.peer]
+                self.dropLink(old)
+            else:
+                print("Dropping duplicate link to node '{}'".format(link.peer))
+                self.dropLink(link)
+                return
+        self.links[link.peer] = link
+        print("Linked to node '{}'".format(link.peer))
+        self.sendSnapshot(link)
+
+    def dropLink(self, link):
+        """
+        Closes a link that should not be kept. An opened link also stops retrying so it is not opened again
+        """
+        if link.outgoing:
+            link.factory.stopTrying()
+        link.transport.loseConnection()
+
+    def linkLost(self, link):
+        """
+        Marks every user logged in on the other node as logged out once its link is lost. They are restored by the snapshot sent
+        when the link is made again
+        """
+        if not link.peer or self.links.get(link.peer) is not link:
+            return
+        del self.links[link.peer]
+        print("Lost link to node '{}'".format(link.peer))
+        for user in self.users.values():
+            if user.node == link.peer:
+                self.removeRemoteUser(user)
+
+    def sendSnapshot(self, link):
+        """
+        Sends all users and rooms known to this node, the messages the other node is missing and the sessions held by this node.
+
+        Each node sends its messages in order, so a message is missing only if it is newer than the newest message the other node
+        has in the same chain from the same node
+        """
+        for user in self.users.values():
+            self.sendRegistration(link, user)
+        for chain in self.messageChains.values():
+            link.sendEvent("room", room=chain.name)
+            peerNewest = link.peerNewest.get(chain.name, {})
+            for message in chain.messages:
+                if message.time.strftime(TIME_FORMAT) > peerNewest.get(message.origin, ""):
+                    self.sendMessage(link, message)
+        for user in self.users.values():
+            if user.protocol and user.node == self.name:
+                link.sendEvent("login", name=user.name)
+                for room in user.rooms:
+                    link.sendEvent("join", room=room, name=user.name)
+
+    def broadcast(self, type, **fields):
+        """
+        Sends an event once over each link
+        """
+        for link in self.links.values():
+            link.sendEvent(type, **fields)
+
+    def sendRegistration(self, link, user):
+        link.sendEvent("register", name=user.name, password=user.password, origin=user.origin,
+                       registered=user.registered.strftime(TIME_FORMAT))
+
+    def sendMessage(self, link, message):
+        link.sendEvent("msg", id=message.id, origin=message.origin, room=message.location, sender=message.sender,
+                       time=message.time.strftime(TIME_FORMAT), text=message.text)
+
+    def newestMessages(self):
+        """
+        Helper method to give the time of the newest message from each node in each message chain, for the hello on a link
+        """
+        newest = {}
+        for (room, origins) in self.newest.items():
+            newest[room] = dict((origin, sent.strftime(TIME_FORMAT))
+                                for (origin, sent) in origins.items())
+        return newest
+
+    def messageAdded(self, message):
+        """
+        Helper method to record a message that was sent on or received by this node
+        """
+        self.messageIds.add(message.id)
+        origins = self.newest.setdefault(message.location, {})
+        if not message.origin in origins or origins[message.origin] < message.time:
+            origins[message.origin] = message.time
+
+    # Events from this node
+
+    def userRegistered(self, user):
+        user.origin = self.name
+        user.registered = datetime.now()
+        for link in self.links.values():
+            self.sendRegistration(link, user)
+
+    def userLoggedIn(self, user):
+        user.node = self.name
+        self.broadcast("login", name=user.name)
+
+    def userLoggedOut(self, user):
+        user.node = None
+        self.broadcast("logout", name=user.name)
+
+    def roomCreated(self, room):
+        self.broadcast("room", room=room)
+
+    def userJoined(self, room, user):
+        self.broadcast("join", room=room, name=user.name)
+
+    def userLeft(self, room, user):
+        self.broadcast("leave", room=room, name=user.name)
+
+    def messageSent(self, message):
+        if message.id is None:
+            message.id = uuid.uuid4().hex
+        message.origin = self.name
+        self.messageAdded(message)
+        for link in self.links.values():
+            self.sendMessage(link, message)
+
+    # Events from other nodes
+
+    def handleEvent(self, link, event):
+        """
+        Takes an event received over a link and applies it to the users and message chains of this node
+
+        Args:
+            link(ChatLink): link the event was received on
+            event(dict): event with a "type" and the fields for that type
+        """
+        type = event.get("type")
+        try:
+            if type == "register":
+                self.registerUser(event["name"], event["password"], event["origin"],
+                                  datetime.strptime(event["registered"], TIME_FORMAT))
+            elif type == "login":
+                self.loginUser(link.peer, event["name"])
+            elif type == "logout":
+                user = self.users.get(event["name"])
+                if user and user.node == link.peer:
+                    self.removeRemoteUser(user)
+            elif type == "room":
+                self.getChain(event["room"])
+            elif type == "join":
+                user = self.users.get(event["name"])
+                if user and user.node == link.peer and not event["room"] in user.rooms:
+                    self.getChain(event["room"]).addUser(user)
+                    user.rooms.append(event["room"])
+            elif type == "leave":
+                user = self.users.get(event["name"])
+                if user and user.node == link.peer and event["room"] in user.rooms:
+                    self.messageChains[event["room"]].removeUser(user)
+                    user.rooms.remove(event["room"])
+            elif type == "msg":
+                self.receiveMessage(event)
+            else:
+                print("Unknown event '{}' from node '{}'".format(type, link.peer))
+        except KeyError as e:
+            print("Event '{}' from node '{}' is missing {}".format(
+                type, link.peer, e))
+
+    def registerUser(self, name, password, origin, registered):
+        """
+        Adds a user registered on another node. If the name was registered on two nodes, the earlier registration is kept, using
+        the node whose name sorts first when both were made at the same time. Any session on this node that logged in with the
+        other password is closed
+        """
+        user = self.users.get(name)
+        if not user:
+            user = User(name, password)
+            user.origin = origin
+            user.registered = registered
+            self.users[name] = user
+        elif (registered, origin) < (user.registered, user.origin):
+            replaced = user.password != password
+            user.password = password
+            user.origin = origin
+            user.registered = registered
+            if replaced and user.protocol:
+                print("User '{}' was registered earlier on node '{}' - closing local session".format(
+                    name, origin))
+                self.closeSession(
+                    user, "User was registered earlier on another server, goodbye!")
+
+    def loginUser(self, peer, name):
+        """
+        Marks a user as logged in on another node, logging out any session for the same user held by a node whose name sorts later
+        """
+        user = self.users.get(name)
+        if not user:
+            return
+        if user.active and user.node and user.node != peer:
+            if user.node < peer:
+                return
+            if user.protocol:
+                print("User '{}' logged in on node '{}' - closing local session".format(
+                    name, peer))
+                self.closeSession(
+                    user, "Logged in from another server, goodbye!")
+            else:
+                self.removeRemoteUser(user)
+        user.active = True
+        user.protocol = None
+        user.node = peer
+
+    def closeSession(self, user, reason):
+        """
+        Helper method to log out a user's session on this node, letting the other nodes know, and disconnect its client
+        """
+        protocol = user.protocol
+        protocol.sendResponse("close", reason)
+        protocol.logoutUser()
+        protocol.transport.loseConnection()
+
+    def removeRemoteUser(self, user):
+        """
+        Helper method to log out a user held by another node and remove them from all rooms
+        """
+        for room in list(user.rooms):
+            if room in self.messageChains:
+                self.messageChains[room].removeUser(user)
+        user.rooms = []
+        user.active = False
+        user.node = None
+
+    def receiveMessage(self, event):
+        """
+        Adds a message sent on another node to its message chain and sends it to the users of this node who joined the chain
+        """
+        if event["id"] in self.messageIds:
+            return
+        chain = self.getChain(event["room"])
+        message = Message(event["room"], event["sender"], datetime.strptime(
+            event["time"], TIME_FORMAT), event["text"], event["id"])
+        message.origin = event["origin"]
+        self.messageAdded(message)
+        chain.messages.append(message)
+        # Snapshots can hold messages older than ones already received
+        if len(chain.messages) > 1 and chain.messages[-2].time > message.time:
+            chain.messages.sort(key=lambda msg: msg.time)
+        for user in chain.users:
+            if user.protocol:
+                user.protocol.sendResponse("msg", message.getFormatted())
+
+    def getChain(self, name):
+        """
+        Helper method to get a message chain, creating it if another node made it first
+        """
+        if not name in self.messageChains:
+            self.messageChains[name] = MessageChain(name)
+        return self.messageChains[name]
@@ -2,10 +2,12 @@ from twisted.internet import reactor, protocol
 from twisted.words.protocols.irc import IRC
 from twisted.internet.protocol import Factory
 import threading
+import socket
 import sys
 import re
 from datetime import datetime
 from chat_classes import *
+from federation import *
 
 
 class ChatServer(IRC):
@@ -17,12 +19,16 @@ class ChatServer(IRC):
         https://twistedmatrix.com/documents/current/api/twisted.words.protocols.irc.IRC.html
     However, the vast major of this code is specific to this project and doesn't follow the IRC protocol methods that closely. 
     """
+    # Longest command accepted from a client, which keeps events sent to other servers under ChatLink.MAX_LENGTH
+    MAX_LENGTH = 16384
 
-    def __init__(self, expectedPrefix, users, messageChains):
+    def __init__(self, expectedPrefix, users, messageChains, node):
         self.prefix = expectedPrefix
         self.users = users
         self.messageChains = messageChains
+        self.node = node
         self.user = None
+        self.discarding = False
 
     def connectionMade(self):
         print("Connected to a client")
@@ -47,6 +53,30 @@ class ChatServer(IRC):
         return (command, prefix, words[1:])
 
     def dataReceived(self, data):
+        """
+        Splits incoming data into lines so that pipelined commands arriving together are each handled
+        """
+        lines = (self.buffer + data).split("\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            if self.discarding:
+                # End of a command that was already rejected for its length
+                self.discarding = False
+            elif len(line) > self.MAX_LENGTH:
+                self.sendResponse("error",
+                                  "Commands cannot be longer than {} bytes".format(self.MAX_LENGTH))
+            else:
+                self.lineReceived(line)
+        if len(self.buffer) > self.MAX_LENGTH:
+            self.buffer = ""
+            if not self.discarding:
+                self.discarding = True
+                self.sendResponse("error",
+                                  "Commands cannot be longer than {} bytes".format(self.MAX_LENGTH))
+
+    def lineReceived(self, data):
+        # Replace bytes that are not UTF-8 so the text can be sent over links to other servers
+        data = data.decode("utf-8", "replace").encode("utf-8")
         (command, prefix, params) = self.parsemsg(data)
         userInfo = self.user.name if self.user else "logged out client"
         print("Content from {}: {} / {} / {}".format(userInfo,
@@ -67,6 +97,8 @@ class ChatServer(IRC):
             if command == "open":
                 self.sendResponse(
                     "open", "Welcome to the chat program! Use {}login to get started".format(self.prefix))
+            elif command == "ping":
+                self.sendResponse("pong", " ".join(params))
             elif command in ["close", "logout", "quit", "exit"]:
                 self.logout(params)
             elif command == "login":
@@ -189,10 +221,12 @@ class ChatServer(IRC):
                     self.users[name].active = True
                     self.users[name].protocol = self
                     self.user = self.users[name]
+                    self.node.userLoggedIn(self.user)
                     self.sendResponse("login",
                                       "Login successful. Welcome to the chat room, {}!".format(name))
             else:
                 self.users[name] = User(name, password)
+                self.node.userRegistered(self.users[name])
                 self.sendResponse("create",
                                   "Registering new user '{}'. Please login again to verify password".format(name))
 
@@ -236,6 +270,7 @@ class ChatServer(IRC):
                                   "Sorry, rooms cannot contain the characters {} or {} due to implementation details".format("|", self.prefix))
             elif not newRoom in self.messageChains:
                 self.messageChains[newRoom] = MessageChain(newRoom)
+                self.node.roomCreated(newRoom)
                 self.sendResponse("create",
                                   "Created new room '{}'!".format(newRoom))
             else:
@@ -356,8 +391,11 @@ class ChatServer(IRC):
                 messageLoc = self.messageChains[target]
                 messageLoc.messages.append(newMessage)
                 for user in messageLoc.users:
-                    user.protocol.sendResponse(
-                        "msg", newMessage.getFormatted())
+                    # Users logged in on other nodes are sent the message by their node
+                    if user.protocol:
+                        user.protocol.sendResponse(
+                            "msg", newMessage.getFormatted())
+                self.node.messageSent(newMessage)
 
     def joinIM(self, args):
         if not self.userLoggedIn():
@@ -382,6 +420,7 @@ class ChatServer(IRC):
                 imName = "IM " + " ".join(users)
                 if not imName in self.messageChains:
                     self.messageChains[imName] = MessageChain(imName)
+                    self.node.roomCreated(imName)
                 self.addUserToRoom(imName)
                 self.sendResponse("im",
                                   "Joined IMs between {}!".format(users))
@@ -427,8 +466,11 @@ class ChatServer(IRC):
                 messageLoc = self.messageChains[imName]
                 messageLoc.messages.append(newMessage)
                 for user in messageLoc.users:
-                    user.protocol.sendResponse(
-                        "msg", newMessage.getFormatted())
+                    # Users logged in on other nodes are sent the message by their node
+                    if user.protocol:
+                        user.protocol.sendResponse(
+                            "msg", newMessage.getFormatted())
+                self.node.messageSent(newMessage)
             else:
                 self.sendResponse("error", "Please start an IM chain first with {}im {}".format(
                     self.prefix, " ".join(targetUsers)))
@@ -450,6 +492,7 @@ class ChatServer(IRC):
             if room and (roomName in self.user.rooms):
                 room.removeUser(self.user)
                 self.user.rooms.remove(roomName)
+                self.node.userLeft(roomName, self.user)
 
     def removeUserFromAllRooms(self):
         rooms = list(dict.fromkeys(self.user.rooms))
@@ -464,6 +507,7 @@ class ChatServer(IRC):
             if roomName and (roomName in self.messageChains and not (roomName in self.user.rooms)):
                 self.messageChains[roomName].addUser(self.user)
                 self.user.rooms.append(roomName)
+                self.node.userJoined(roomName, self.user)
 
     def logoutUser(self):
         """
@@ -473,6 +517,7 @@ class ChatServer(IRC):
             self.removeUserFromAllRooms()
             self.users[self.user.name].active = False
             self.users[self.user.name].protocol = None
+            self.node.userLoggedOut(self.user)
             self.user = None
 
     def sendResponse(self, command, params):
@@ -494,23 +539,51 @@ class ChatServer(IRC):
 class ChatServerFactory(Factory):
     """
     A factory class that takes the ChatSever protocol and holds state/listens to connection.
+
+    The state is shared with other servers through the ChatNode in federation.py once links are made
     """
 
-    def __init__(self, prefix):
+    def __init__(self, prefix, name):
         self.prefix = prefix
         self.users = {}
         self.messages = {}
+        self.node = ChatNode(name, self.users, self.messages)
 
     def buildProtocol(self, addr):
         print("Protocol built")
-        return ChatServer(self.prefix, self.users, self.messages)
+        return ChatServer(self.prefix, self.users, self.messages, self.node)
 
 
 if __name__ == '__main__':
     print("Starting server")
     prefix = "!"
+    port = 8000
+    name = None
+    linkPort = None
+    linkHost = "localhost"
+    peers = []
     for arg in sys.argv:
         if re.search("^--prefix=.$", arg):
             prefix = arg[-1]
-    reactor.listenTCP(8000, ChatServerFactory(prefix))
+        elif re.search("^--port=[0-9]+$", arg):
+            port = int(arg.split("=", 1)[1])
+        elif re.search("^--node=.+$", arg):
+            name = arg.split("=", 1)[1]
+        elif re.search("^--link-port=[0-9]+$", arg):
+            linkPort = int(arg.split("=", 1)[1])
+        elif re.search("^--link-host=.+$", arg):
+            linkHost = arg.split("=", 1)[1]
+        elif re.search("^--peer=.+:[0-9]+$", arg):
+            (host, peerPort) = arg.split("=", 1)[1].rsplit(":", 1)
+            peers.append((host, int(peerPort)))
+    if not name:
+        name = "{}:{}".format(socket.gethostname(), port)
+    factory = ChatServerFactory(prefix, name)
+    reactor.listenTCP(port, factory)
+    if linkPort:
+        # Links are not authenticated and carry every password, so only localhost can connect unless --link-host says otherwise
+        reactor.listenTCP(linkPort, ChatLinkFactory(
+            factory.node), interface=linkHost)
+    for (host, peerPort) in peers:
+        reactor.connectTCP(host, peerPort, ChatPeerFactory(factory.node))
     reactor.run()
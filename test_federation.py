@@ -0,0 +1,301 @@
+from twisted.internet import task
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.test import proto_helpers
+import unittest
+from server import *
+from federation import *
+
+
+class FakePeerFactory:
+    """
+    Stands in for ChatPeerFactory so tests can see when a node stops retrying a link
+    """
+
+    def __init__(self):
+        self.stopped = False
+
+    def stopTrying(self):
+        self.stopped = True
+
+
+class LinkTransport(proto_helpers.StringTransport):
+    """
+    In-memory transport with the TCP methods used by ChatLink
+    """
+    keepAlive = False
+
+    def setTcpKeepAlive(self, enabled):
+        self.keepAlive = enabled
+
+    def abortConnection(self):
+        self.loseConnection()
+
+
+class LinkPair:
+    """
+    Connects two ChatNodes with a pair of ChatLinks over in-memory transports. The first node opens the link
+    """
+
+    def __init__(self, first, second, clock=None):
+        self.clock = clock or task.Clock()
+        self.opened = ChatLink(first, True, self.clock)
+        self.opened.factory = FakePeerFactory()
+        self.accepted = ChatLink(second, False, self.clock)
+        self.connected = True
+        self.sent = {self.opened: "", self.accepted: ""}
+        for link in (self.opened, self.accepted):
+            link.makeConnection(LinkTransport())
+        self.pump()
+
+    def pump(self):
+        """
+        Passes data between the links until neither has anything left to send, then disconnects them if either was closed
+        """
+        moved = True
+        while moved and self.connected:
+            moved = False
+            for (source, target) in ((self.opened, self.accepted), (self.accepted, self.opened)):
+                data = source.transport.value()
+                if data:
+                    self.sent[source] += data
+                    source.transport.clear()
+                    target.dataReceived(data)
+                    moved = True
+        if self.opened.transport.disconnecting or self.accepted.transport.disconnecting:
+            self.disconnect()
+
+    def disconnect(self):
+        if self.connected:
+            self.connected = False
+            for link in (self.opened, self.accepted):
+                link.connectionLost(Failure(ConnectionDone()))
+
+
+def session(factory, name, password="pw"):
+    """
+    Helper function to register and log in a user on a server, returning the protocol for the session
+    """
+    server = factory.buildProtocol(None)
+    server.makeConnection(proto_helpers.StringTransport())
+    server.dataReceived("!login {} {}\n!login {} {}\n".format(
+        name, password, name, password))
+    return server
+
+
+def responses(server):
+    return server.transport.value().splitlines()
+
+
+class ChatNodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.a = ChatServerFactory("!", "a")
+        self.b = ChatServerFactory("!", "b")
+
+    def test_snapshotReplay(self):
+        u = session(self.a, "u")
+        u.dataReceived("!create r\n!join r\n!msg r | hello\n")
+        pair = LinkPair(self.a.node, self.b.node)
+        self.assertTrue(self.b.users["u"].active)
+        self.assertEqual(self.b.users["u"].node, "a")
+        self.assertEqual([msg.text for msg in self.b.messages["r"].messages], [
+                         "hello"])
+        self.assertEqual(
+            [user.name for user in self.b.messages["r"].users], ["u"])
+
+        pair.disconnect()
+        self.assertFalse(self.b.users["u"].active)
+        self.assertEqual(self.b.messages["r"].users, [])
+
+        LinkPair(self.b.node, self.a.node)
+        self.assertTrue(self.b.users["u"].active)
+        self.assertEqual(len(self.b.messages["r"].messages), 1)
+        self.assertEqual(len(self.a.messages["r"].messages), 1)
+
+    def test_snapshotSendsOnlyMissingMessages(self):
+        u = session(self.a, "u")
+        u.dataReceived("!create r\n!join r\n!msg r | one\n!msg r | two\n")
+        pair = LinkPair(self.a.node, self.b.node)
+        self.assertEqual(pair.sent[pair.opened].count('"msg"'), 2)
+        v = session(self.b, "v")
+        v.dataReceived("!join r\n!msg r | three\n")
+        pair.pump()
+        pair.disconnect()
+
+        u.dataReceived("!msg r | four\n")
+        v.dataReceived("!msg r | five\n")
+        pair = LinkPair(self.b.node, self.a.node)
+        self.assertEqual(pair.sent[pair.opened].count('"msg"'), 1)
+        self.assertEqual(pair.sent[pair.accepted].count('"msg"'), 1)
+        for factory in (self.a, self.b):
+            self.assertEqual(sorted(msg.text for msg in factory.messages["r"].messages), [
+                             "five", "four", "one", "three", "two"])
+
+    def test_messageSentOncePerLink(self):
+        pair = LinkPair(self.a.node, self.b.node)
+        u = session(self.a, "u")
+        u.dataReceived("!create r\n!join r\n")
+        pair.pump()
+        v = session(self.b, "v")
+        w = session(self.b, "w")
+        v.dataReceived("!join r\n")
+        w.dataReceived("!join r\n")
+        pair.pump()
+        u.dataReceived("!msg r | hello\n")
+        self.assertEqual(pair.opened.transport.value().count('"msg"'), 1)
+        pair.pump()
+        self.assertTrue(responses(v)[-1].endswith("<u>: hello"))
+        self.assertTrue(responses(w)[-1].endswith("<u>: hello"))
+
+    def test_imBetweenNodes(self):
+        pair = LinkPair(self.a.node, self.b.node)
+        u = session(self.a, "u")
+        v = session(self.b, "v")
+        pair.pump()
+        u.dataReceived("!im v\n")
+        pair.pump()
+        v.dataReceived("!im u\n")
+        pair.pump()
+        u.dataReceived("!privmsg v | secret\n")
+        pair.pump()
+        self.assertTrue(responses(v)[-1].endswith("<u>: secret"))
+        v.dataReceived("!privmsg u | reply\n")
+        pair.pump()
+        self.assertTrue(responses(u)[-1].endswith("<v>: reply"))
+        for factory in (self.a, self.b):
+            self.assertEqual([msg.text for msg in factory.messages["IM u v"].messages], [
+                             "secret", "reply"])
+
+    def test_listingsUseCopiedState(self):
+        pair = LinkPair(self.a.node, self.b.node)
+        u = session(self.a, "u")
+        u.dataReceived("!create r\n!join r\n")
+        session(self.a, "w").logoutUser()
+        pair.pump()
+        v = session(self.b, "v")
+        v.dataReceived("!join r\n")
+        pair.pump()
+        v.dataReceived("!list rooms\n!list users\n!list users r\n")
+        (rooms, users, roomUsers) = responses(v)[-3:]
+        self.assertEqual(rooms, "!list These are available rooms: ['r']")
+        self.assertIn("'u': True", users)
+        self.assertIn("'w': False", users)
+        self.assertIn("'v': True", users)
+        self.assertEqual(
+            roomUsers, "!list These are users that have joined the room 'r': ['u', 'v']")
+        u.dataReceived("!list users r\n")
+        self.assertEqual(
+            responses(u)[-1], "!list These are users that have joined the room 'r': ['u', 'v']")
+
+    def test_userLoggedInOnBothNodes(self):
+        session(self.a, "x")
+        xb = session(self.b, "x")
+        LinkPair(self.b.node, self.a.node)
+        self.assertEqual(self.a.users["x"].node, "a")
+        self.assertEqual(self.b.users["x"].node, "a")
+        self.assertIsNone(self.b.users["x"].protocol)
+        self.assertTrue(responses(xb)[-1].startswith("!close"))
+        self.assertTrue(xb.transport.disconnecting)
+
+    def test_registrationConflictClosesSession(self):
+        session(self.b, "x", "first").logoutUser()
+        xa = session(self.a, "x", "second")
+        LinkPair(self.b.node, self.a.node)
+        for factory in (self.a, self.b):
+            self.assertEqual(factory.users["x"].password, "first")
+            self.assertEqual(factory.users["x"].origin, "b")
+            self.assertFalse(factory.users["x"].active)
+        self.assertTrue(responses(xa)[-1].startswith("!close"))
+
+    def test_laterRegistrationDoesNotReplacePassword(self):
+        alice = session(self.b, "alice", "secret")
+        # a starts with no state, so the name can be registered again there
+        session(self.a, "alice", "attacker").logoutUser()
+        LinkPair(self.b.node, self.a.node)
+        for factory in (self.a, self.b):
+            self.assertEqual(factory.users["alice"].password, "secret")
+        self.assertIs(self.b.users["alice"].protocol, alice)
+        self.assertFalse(alice.transport.disconnecting)
+        self.assertEqual(self.a.users["alice"].node, "b")
+
+    def test_matchingRegistrationsKeepEarliest(self):
+        c = ChatServerFactory("!", "c")
+        session(c, "x")
+        session(self.b, "x")
+        session(self.a, "x").logoutUser()
+        LinkPair(self.b.node, c.node)
+        LinkPair(self.a.node, self.b.node)
+        LinkPair(self.a.node, c.node)
+        for factory in (self.a, self.b, c):
+            self.assertEqual(factory.users["x"].origin, "c")
+            self.assertEqual(
+                factory.users["x"].registered, c.users["x"].registered)
+
+    def test_duplicateLinkKeepsLinkOpenedByFirstNode(self):
+        first = LinkPair(self.a.node, self.b.node)
+        second = LinkPair(self.b.node, self.a.node)
+        self.assertTrue(first.connected)
+        self.assertFalse(second.connected)
+        self.assertTrue(second.opened.factory.stopped)
+        self.assertIs(self.a.node.links["b"], first.opened)
+        self.assertIs(self.b.node.links["a"], first.accepted)
+
+    def test_staleLinkReplacedByReconnect(self):
+        stale = LinkPair(self.b.node, self.a.node)
+        # b sees its link close while a never hears about it
+        stale.connected = False
+        stale.opened.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(self.b.node.links, {})
+        self.assertIs(self.a.node.links["b"], stale.accepted)
+
+        fresh = LinkPair(self.b.node, self.a.node)
+        self.assertTrue(fresh.connected)
+        self.assertFalse(fresh.opened.factory.stopped)
+        self.assertTrue(stale.accepted.transport.disconnecting)
+        self.assertIs(self.a.node.links["b"], fresh.accepted)
+        self.assertIs(self.b.node.links["a"], fresh.opened)
+
+    def test_heartbeat(self):
+        pair = LinkPair(self.a.node, self.b.node)
+        self.assertTrue(pair.opened.transport.keepAlive)
+        for i in range(10):
+            pair.clock.advance(ChatLink.heartbeatInterval)
+            pair.pump()
+        self.assertTrue(pair.connected)
+        self.assertIs(self.a.node.links["b"], pair.opened)
+
+        # Nothing gets through once the link goes silently dead
+        for i in range(4):
+            pair.clock.advance(ChatLink.heartbeatInterval)
+        self.assertTrue(pair.opened.transport.disconnecting)
+        self.assertTrue(pair.accepted.transport.disconnecting)
+        pair.disconnect()
+        self.assertEqual(self.a.node.links, {})
+        self.assertEqual(self.b.node.links, {})
+
+    def test_invalidUtf8(self):
+        pair = LinkPair(self.a.node, self.b.node)
+        u = session(self.a, "u")
+        u.dataReceived("!create r\n!join r\n!msg r | caf\xe9\n")
+        pair.pump()
+        self.assertTrue(pair.connected)
+        self.assertEqual(
+            self.b.messages["r"].messages[0].text, "caf\xef\xbf\xbd")
+        pair.opened.sendEvent("msg", text="caf\xe9")
+        self.assertEqual(pair.opened.transport.value(), "")
+
+    def test_longMessage(self):
+        pair = LinkPair(self.a.node, self.b.node)
+        u = session(self.a, "u")
+        u.dataReceived("!create r\n!join r\n!msg r | {}\n".format(
+            "\xe4\xb8\xad" * 3000))
+        pair.pump()
+        self.assertTrue(pair.connected)
+        self.assertEqual(len(self.b.messages["r"].messages), 1)
+        u.dataReceived("!msg r | {}\n".format("x" * 17000))
+        self.assertTrue(responses(u)[-1].startswith("!error"))
+
+
+if __name__ == '__main__':
+    unittest.main()